@@ -0,0 +1,286 @@
+# coding: utf-8
+# Throughput and latency benchmark for the spot pipeline.
+#
+#   python bench/bench_spots.py [--cycles 50] [--spots 40] [--dup 0.5]
+#                               [--users 2000] [--json result.json]
+#
+# Feeds are generated in-process and served by a local HTTP stand-in for
+# the mdspots.toml endpoints. MQTT goes to an in-process sink, the
+# potalog/mqttuser DB is synthetic, and the Twitter/Mastodon/Nostr clients
+# are stubs, so nothing leaves the machine.
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import toml
+import mdspots
+
+MODES = ['CW', 'SSB', 'FT8', 'FT4', 'FM']
+BANDS = [3530, 7010, 7074, 10120, 14060, 14074, 18080, 21060, 28060, 50313, 144200]
+
+
+class Feeds:
+    def __init__(self, spots, dup, refs, window, seed):
+        self.rand = random.Random(seed)
+        self.spots = spots
+        self.dup = dup
+        self.refs = refs
+        self.window = window
+        self.lastid = {'pota': 100000, 'sota': 500000}
+        self.feed = {'pota': [], 'sota': []}
+        self.active = {'pota': [], 'sota': []}
+        self.lock = threading.Lock()
+
+    def activation(self, prog):
+        n = self.rand.randrange(self.refs)
+        call = f'JA{self.rand.randrange(10)}{chr(65 + n % 26)}{chr(65 + n // 26 % 26)}{chr(65 + n // 676 % 26)}'
+        mode = self.rand.choice(MODES)
+        freq = self.rand.choice(BANDS)
+        if prog == 'pota':
+            return {'act': call, 'ref': f'JA-{n:04d}', 'freq': freq, 'mode': mode}
+        return {'act': call, 'ref': ('JA', f'NI-{n % 1000:03d}'), 'freq': freq, 'mode': mode}
+
+    def spot(self, prog, a, sid):
+        tm = datetime.utcnow().isoformat(timespec='milliseconds')
+        selfspot = self.rand.random() < 0.1
+        spotter = a['act'] if selfspot else f'JH{self.rand.randrange(10)}XYZ'
+        comment = '2-fer JA-0001 JP-Tokyo' if selfspot else self.rand.choice(['', 'tnx', 'QSB'])
+        if prog == 'pota':
+            return {'spotId': sid, 'reference': a['ref'], 'activator': a['act'],
+                    'spotTime': tm, 'frequency': str(a['freq']), 'mode': a['mode'],
+                    'name': 'Park', 'locationDesc': 'JP-Tokyo', 'spotter': spotter,
+                    'comments': comment}
+        return {'id': sid, 'associationCode': a['ref'][0], 'summitCode': a['ref'][1],
+                'activatorCallsign': a['act'], 'timeStamp': tm,
+                'frequency': f"{a['freq'] / 1000:.3f}", 'mode': a['mode'],
+                'summitDetails': 'Summit', 'callsign': spotter, 'comments': comment}
+
+    def advance(self):
+        with self.lock:
+            for prog in self.feed:
+                for _ in range(self.spots):
+                    if self.active[prog] and self.rand.random() < self.dup:
+                        a = self.rand.choice(self.active[prog])
+                    else:
+                        a = self.activation(prog)
+                        self.active[prog] = (self.active[prog] + [a])[-self.refs:]
+                    self.lastid[prog] += 1
+                    self.feed[prog].insert(0, self.spot(prog, a, self.lastid[prog]))
+                del self.feed[prog][self.window:]
+
+    def body(self, path):
+        with self.lock:
+            if path.startswith('/pota/spots'):
+                return self.feed['pota']
+            if path.startswith('/sota/spots'):
+                return self.feed['sota']
+            if path.startswith('/getref'):
+                return {'counts': 1, 'reference': [{'name': 'Park', 'name_k': '公園'}]}
+            return []
+
+
+def serve(feeds):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            b = json.dumps(feeds.body(self.path)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(b)))
+            self.end_headers()
+            self.wfile.write(b)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+class MQTTResult:
+    rc = 0
+
+
+class MQTTSink:
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload=None, *args, **kwargs):
+        with self.lock:
+            self.count += 1
+        return MQTTResult()
+
+
+class StubResult:
+    data = {'id': 1}
+
+
+class StubTwitter:
+    def create_tweet(self, **kwargs):
+        return StubResult()
+
+
+class StubMastodon:
+    def status_post(self, mesg, **kwargs):
+        return {'id': 1}
+
+
+def make_mqttdb(fname, users, refs, qsos, rand):
+    db = sqlite3.connect(fname)
+    db.execute('create table mqttuser(uuid text, time int)')
+    db.execute('create table potalog(uuid text, ref text, call text, mode text, qsod text)')
+    db.executemany('insert into mqttuser values(?, ?)',
+                   ((f'user{u:05d}', 0) for u in range(users)))
+    db.executemany('insert into potalog values(?, ?, ?, ?, ?)',
+                   ((f'user{u:05d}', f'JA-{rand.randrange(refs):04d}', 'JA1XXX', 'CW', '2024-01-01')
+                    for u in range(users) for _ in range(qsos)))
+    db.commit()
+    db.close()
+
+
+def make_spotter(home, base, args):
+    sysobj = toml.load(ROOT + '/mdspots.toml')
+    cfg = toml.load(ROOT + '/config.toml')
+    config = cfg['config']
+    config.update({'homedir': home, 'logdir': home, 'mqttdb': home + 'mqtt.db',
+                   'query_socket': home + 'mdspots.sock',
+                   'outbox_interval': {'tweet': 0, 'toot': 0, 'nostr': 0}})
+
+    endpoints = sysobj['endpoints']
+    endpoints['pota'].update({'spots': base + '/pota/spots?', 'alerts': base + '/pota/alerts?'})
+    endpoints['sota'].update({'spots': base + '/sota/spots?', 'alerts': base + '/sota/alerts?'})
+    endpoints['sotalive']['getref'] = base + '/getref?'
+
+    for p in sysobj['programs']:
+        config[p].update({'enable_tweet': True, 'enable_toot': True,
+                          'enable_nostr': True, 'enable_mqtt': False})
+
+    translates = {'alerts': sysobj['alert_translates'],
+                  'spots': sysobj['spot_translates']}
+    spotter = mdspots.MDSpotter(programs=sysobj['programs'], endpoints=endpoints,
+                                translates=translates, accesskeys=cfg['accesskeys'],
+                                config=config)
+
+    spotter.mqtt = MQTTSink()
+    for p in sysobj['programs']:
+        config[p]['enable_mqtt'] = True
+        spotter.twapi[p] = StubTwitter()
+        spotter.mdapi[p] = StubMastodon()
+    spotter.post_nostr_event = lambda prog, repl_id, mesg: 'id'
+    return spotter
+
+
+def timeit(f, runs):
+    res = []
+    for _ in range(runs):
+        t = time.perf_counter()
+        f()
+        res.append(time.perf_counter() - t)
+    return statistics.median(res) * 1000
+
+
+def percentile(v, p):
+    v = sorted(v)
+    return v[min(len(v) - 1, int(round(p / 100 * (len(v) - 1))))]
+
+
+def revision():
+    try:
+        return subprocess.run(['git', '-C', ROOT, 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--cycles', type=int, default=50)
+    ap.add_argument('--spots', type=int, default=40, help='new spots per program per cycle')
+    ap.add_argument('--dup', type=float, default=0.5, help='ratio of spots repeating an activation')
+    ap.add_argument('--refs', type=int, default=500)
+    ap.add_argument('--window', type=int, default=200, help='spots kept in each feed')
+    ap.add_argument('--users', type=int, default=2000)
+    ap.add_argument('--qsos', type=int, default=20, help='potalog rows per user')
+    ap.add_argument('--runs', type=int, default=5, help='repetitions per query timing')
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--json', help='write results to this file')
+    args = ap.parse_args()
+
+    home = tempfile.mkdtemp(prefix='mdbench') + '/'
+    try:
+        rand = random.Random(args.seed)
+        make_mqttdb(home + 'mqtt.db', args.users, args.refs, args.qsos, rand)
+        feeds = Feeds(args.spots, args.dup, args.refs, args.window, args.seed)
+        spotter = make_spotter(home, serve(feeds), args)
+
+        latency = []
+        t0 = time.perf_counter()
+        for _ in range(args.cycles):
+            feeds.advance()
+            t = time.perf_counter()
+            spotter.periodical()
+            latency.append(time.perf_counter() - t)
+        if spotter.fanout:
+            spotter.fanout.flush()
+        elapsed = time.perf_counter() - t0
+        spots = args.cycles * args.spots * len(spotter.programs)
+
+        mesg = {'tm': '00:00', 'act': 'JA1ABC', 'refid': 'JA-0001', 'name': 'Park',
+                'freq': '7010', 'mode': 'CW', 'cmt': '', 'spt': 'JH1XYZ'}
+        queries = {
+            'POTA JA': lambda: spotter.interp('POTA JA'),
+            'POTA DX 60': lambda: spotter.interp('POTA DX 60'),
+            'POTA JA LOG 24': lambda: spotter.interp('POTA JA LOG 24'),
+            'POTA STAT': lambda: spotter.interp('POTA STAT'),
+            'summary(pota)': lambda: spotter.summary('pota'),
+            'mqtt_publish_client': lambda: (spotter.mqtt_publish_client('spot/pota/ja', dict(mesg)),
+                                            spotter.fanout.flush()),
+        }
+        qtimes = {k: timeit(f, args.runs) for (k, f) in queries.items()}
+
+        result = {
+            'revision': revision(),
+            'args': vars(args),
+            'spots_per_sec': spots / elapsed,
+            'cycle_ms': {f'p{p}': percentile(latency, p) * 1000 for p in (50, 90, 99)},
+            'cycle_ms_max': max(latency) * 1000,
+            'mqtt_messages': spotter.mqtt.count,
+            'query_ms': qtimes,
+        }
+
+        print(f"revision {result['revision']}  {spots} spots in {args.cycles} cycles, "
+              f"{args.users} users")
+        print(f"{'spots/sec':24s} {result['spots_per_sec']:10.1f}")
+        for (k, v) in result['cycle_ms'].items():
+            print(f"{'cycle ' + k + ' (ms)':24s} {v:10.2f}")
+        print(f"{'cycle max (ms)':24s} {result['cycle_ms_max']:10.2f}")
+        print(f"{'mqtt messages':24s} {result['mqtt_messages']:10d}")
+        for (k, v) in qtimes.items():
+            print(f"{k + ' (ms)':24s} {v:10.2f}")
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(result, f, indent=2)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
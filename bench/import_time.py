@@ -0,0 +1,91 @@
+# coding: utf-8
+# Cold-start cost of the mdspots entry points.
+#
+#   python bench/import_time.py [runs]
+#
+# Each case runs in a fresh interpreter and reports the median wall time.
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BACKENDS = ['tweepy', 'mastodon', 'nostr.event', 'nostr.relay_manager',
+            'nostr.key', 'paho.mqtt.client', 'requests', 'schedule']
+
+SETUP = f"""
+import sys, time
+sys.path.insert(0, {ROOT!r})
+t = time.perf_counter()
+"""
+
+CASES = {
+    'import mdspots': 'import mdspots',
+    'import output backends': '\n'.join(
+        f'try:\n    import {m}\nexcept ImportError:\n    pass' for m in BACKENDS),
+    'interp (read-only MDSpotter)': """
+import mdspots, toml
+sysobj = toml.load({root!r} + '/mdspots.toml')
+cfg = toml.load({root!r} + '/config.toml')
+cfg['config']['homedir'] = {home!r}
+s = mdspots.MDSpotter(programs=sysobj['programs'], endpoints=sysobj['endpoints'],
+                      translates=None, accesskeys=cfg['accesskeys'],
+                      config=cfg['config'], readonly=True)
+s.interp('POTA JA LOG')
+""",
+}
+
+
+def make_db(home):
+    sys.path.insert(0, ROOT)
+    import mdspots
+    import toml
+
+    db = sqlite3.connect(home + 'mqtt.db')
+    db.execute('create table mqttuser(uuid text, time int)')
+    db.execute('create table potalog(uuid text, ref text, call text, mode text, qsod text)')
+    db.close()
+
+    sysobj = toml.load(ROOT + '/mdspots.toml')
+    cfg = toml.load(ROOT + '/config.toml')
+    config = cfg['config']
+    config.update({'homedir': home, 'logdir': home, 'mqttdb': home + 'mqtt.db',
+                   'archive_dir': ''})
+    for p in sysobj['programs']:
+        config[p]['enable_mqtt'] = False
+    translates = {'alerts': sysobj['alert_translates'],
+                  'spots': sysobj['spot_translates']}
+    s = mdspots.MDSpotter(programs=sysobj['programs'], endpoints=sysobj['endpoints'],
+                          translates=translates, accesskeys=cfg['accesskeys'], config=config)
+    s.logger.flush()
+    del s
+
+
+def run(code, runs):
+    res = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', SETUP + code +
+                              '\nprint(time.perf_counter() - t)'],
+                             capture_output=True, text=True)
+        if out.returncode:
+            return None
+        res.append(float(out.stdout.split()[-1]))
+    return statistics.median(res) * 1000
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    with tempfile.TemporaryDirectory() as home:
+        home += '/'
+        make_db(home)
+
+        for (name, code) in CASES.items():
+            t = run(code.format(root=ROOT, home=home), runs)
+            if t is None:
+                print(f'{name:32s} failed')
+            else:
+                print(f'{name:32s} {t:8.1f} ms')
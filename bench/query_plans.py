@@ -0,0 +1,96 @@
+# coding: utf-8
+# Query-plan check for the statements in mdspots.Queries.
+#
+#   python bench/query_plans.py [-v] [--rows 20000]
+#
+# Every named statement is planned with each combination of its optional
+# filters, on a fresh schema and again after loading synthetic spots and
+# running ANALYZE. A plan that reads a table with a full SCAN fails the
+# check and the script exits non-zero.
+import argparse
+import itertools
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_spots
+from bench_spots import MODES, BANDS
+
+FULL_SCAN = re.compile(r'SCAN (?!\(subquery|CONSTANT)')
+
+
+def load(spotter, rows, rand):
+    now = int(time.time())
+    spots = []
+    for i in range(rows):
+        n = rand.randrange(2000)
+        prog = rand.choice(spotter.programs)
+        region = rand.choice(['JA', 'JA', 'JA', 'K', 'VE', 'DL'])
+        call = f'{region}{rand.randrange(10)}{chr(65 + n % 26)}{chr(65 + n // 26 % 26)}'
+        utc = now - rand.randrange(7 * 86400)
+        spotter.spotrow += 1
+        spots.append((spotter.spotrow, utc, '00:00', prog, call, f'{region}-{n:04d}', 'Park',
+                      rand.choice(BANDS), '', rand.choice(MODES), '', region, '', 'JH1XYZ',
+                      rand.randrange(2)))
+        spotter.rollups.add(utc, prog, region, f'{region}-{n:04d}', call, spots[-1][9],
+                            spots[-1][-1])
+    spotter.queries.runmany(spotter.cur, 'insert_spot', spots)
+    spotter.rollups.flush()
+    spotter.db.commit()
+    spotter.db.execute('analyze')
+
+
+def plans(spotter):
+    for (name, (head, clauses, tail)) in spotter.queries.statements.items():
+        keys = [k for (k, _) in clauses]
+        for n in range(len(keys) + 1):
+            for used in itertools.combinations(keys, n):
+                filters = {k: ('JA', 'JB') if '>=' in c else 1
+                           for (k, c) in clauses if k in used}
+                (q, params) = spotter.queries.bind(name, [], filters)
+                params = [0] * (q.count('?') - len(params)) + params
+                plan = [r[3] for r in spotter.db.execute('explain query plan ' + q, params)]
+                yield (name, used, plan)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-v', action='store_true', help='print every plan')
+    ap.add_argument('--rows', type=int, default=20000, help='synthetic spots before ANALYZE')
+    args = ap.parse_args()
+
+    home = tempfile.mkdtemp(prefix='mdplans') + '/'
+    try:
+        rand = random.Random(1)
+        bench_spots.make_mqttdb(home + 'mqtt.db', 1, 1, 1, rand)
+        spotter = bench_spots.make_spotter(home, 'http://127.0.0.1:9', args)
+
+        failed = 0
+        for stage in ['fresh', 'analyzed']:
+            if stage == 'analyzed':
+                load(spotter, args.rows, rand)
+            for (name, used, plan) in plans(spotter):
+                bad = [p for p in plan if FULL_SCAN.match(p)]
+                if bad or args.v:
+                    label = f"{stage} {name}({', '.join(used)})"
+                    print(f"{'FAIL' if bad else 'ok':4s} {label}")
+                    for p in plan:
+                        print(f'       {p}')
+                failed += bool(bad)
+
+        print(f'{failed} statement plan(s) with a full scan.' if failed else 'All plans use an index.')
+        sys.exit(1 if failed else 0)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,1056 @@
 # coding: utf-8
-from datetime import datetime
+import array
+import atexit
+from datetime import datetime, timezone
+import hashlib
+import importlib.util
 import pickle
-import urllib.request
+import urllib.parse
 import json
 import math
-from paho.mqtt import client as mqtt
+import operator
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 import os
 import pytz
+import queue
 import re
-import requests
-import schedule
+import socket
+import socketserver
 import ssl
 import sys
 import sqlite3
+import threading
 import time
 import toml
+import zipfile
+
+
+class Logger:
+    def __init__(self, fname, size, max_bytes, rotate, backups, verbosity):
+        self.fname = fname
+        self.max_bytes = max_bytes
+        self.rotate = rotate
+        self.backups = backups
+        self.verbosity = verbosity
+        self.sampled = {}
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=size)
+        self.file = None
+        self.thread = threading.Thread(
+            target=self.run, name='logger', daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def log(self, mesg, cat='main'):
+        if mesg.startswith(('Error', 'Warning', 'Failed')):
+            self.queue.put(f'{datetime.now()}: {mesg}')
+            return
+
+        v = self.verbosity.get(cat, 1)
+        if v != 1:
+            if v == 0:
+                return
+            n = self.sampled.get(cat, 0)
+            self.sampled[cat] = n + 1
+            if n % v:
+                return
+
+        try:
+            self.queue.put_nowait(f'{datetime.now()}: {mesg}')
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        self.queue.join()
+
+    def open(self):
+        self.file = open(self.fname, mode='a')
+        self.opened = datetime.now().date()
+
+    def do_rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.fname}.{i}'):
+                os.replace(f'{self.fname}.{i}', f'{self.fname}.{i + 1}')
+        if self.backups:
+            os.replace(self.fname, f'{self.fname}.1')
+        else:
+            os.unlink(self.fname)
+        self.open()
+
+    def run(self):
+        while True:
+            lines = [self.queue.get()]
+            while True:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if not self.file:
+                    self.open()
+                elif (self.rotate == 'daily' and self.opened != datetime.now().date()) or \
+                        (self.max_bytes and self.file.tell() > self.max_bytes):
+                    self.do_rotate()
+                print('\n'.join(lines), file=self.file, flush=True)
+            except Exception as e:
+                print(f'{datetime.now()}: Error:{e} {self.fname}', file=sys.stderr)
+                self.file = None
+            for _ in lines:
+                self.queue.task_done()
+
+
+class PotaLogCache:
+    def __init__(self, db):
+        self.db = db
+        self.cur = db.cursor()
+        self.data_version = None
+        self.users = []
+        self.qso = {}
+        self.lastrow = 0
+        self.rows = 0
+
+    def refresh(self):
+        (version,) = self.cur.execute('pragma data_version').fetchone()
+        if version == self.data_version:
+            return
+        self.data_version = version
+
+        self.users = [u for (u, _) in self.cur.execute(
+            'select * from mqttuser')]
+
+        (count,) = self.cur.execute('select count(*) from potalog').fetchone()
+        q = 'select rowid, uuid, ref, * from potalog where rowid > ? order by rowid'
+        newrows = self.cur.execute(q, (self.lastrow,)).fetchall()
+        if self.rows + len(newrows) != count:
+            self.qso = {}
+            self.lastrow = 0
+            self.rows = 0
+            newrows = self.cur.execute(q, (0,)).fetchall()
+
+        for r in newrows:
+            (rowid, uuid, ref) = r[:3]
+            e = self.qso.get((uuid, ref))
+            if e:
+                e[0] += 1
+            else:
+                self.qso[(uuid, ref)] = [1, r[3 + 4]]
+            self.lastrow = rowid
+        self.rows += len(newrows)
+
+    def lookup(self, uuid, ref):
+        return self.qso.get((uuid, ref), (0, ''))
+
+
+class Fanout:
+    def __init__(self, publish, log, metrics, workers, depth):
+        self.publish = publish
+        self.log = log
+        self.metrics = metrics
+        self.queues = []
+        for i in range(workers):
+            q = queue.Queue(maxsize=depth)
+            self.queues.append(q)
+            self.metrics.set('queue_depth', q.qsize, queue=f'fanout{i}')
+            threading.Thread(target=self.run, args=(q,),
+                             name=f'fanout{i}', daemon=True).start()
+
+    def shard(self, uuid):
+        return hash(uuid) % len(self.queues)
+
+    def submit(self, topic, key, shards):
+        now = time.perf_counter()
+        for (q, items) in zip(self.queues, shards):
+            if not items:
+                continue
+            while True:
+                try:
+                    q.put_nowait((topic, key, items, now))
+                    break
+                except queue.Full:
+                    try:
+                        (_, _, old, _) = q.get_nowait()
+                        q.task_done()
+                        self.metrics.incr('fanout_dropped_total', len(old))
+                    except queue.Empty:
+                        pass
+
+    def flush(self):
+        for q in self.queues:
+            q.join()
+
+    def run(self, q):
+        while True:
+            batch = [q.get()]
+            while True:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+
+            latest = {}
+            for b in batch:
+                latest[(b[0], b[1])] = b
+            if len(latest) < len(batch):
+                self.metrics.incr('fanout_coalesced_total', len(batch) - len(latest))
+
+            for (topic, key, items, t) in latest.values():
+                failed = 0
+                for (uuid, mesg) in items:
+                    res = self.publish(uuid + '/' + topic, mesg)
+                    if res.rc:
+                        failed += 1
+                    self.log(
+                        f"MQTTPublish({res}): {mesg} to {uuid}/{topic}", 'mqtt_user')
+                self.metrics.observe('fanout_latency_seconds',
+                                     time.perf_counter() - t)
+                self.metrics.incr('output_total', len(items) - failed,
+                                  output='mqtt_user', result='ok')
+                if failed:
+                    self.metrics.incr('output_total', failed,
+                                      output='mqtt_user', result='failed')
+
+            for _ in batch:
+                q.task_done()
+
+
+class RefNameCache:
+    def __init__(self, dbname, ttl, negative_ttl, size):
+        self.db = sqlite3.connect(dbname)
+        self.cur = self.db.cursor()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self.lru = OrderedDict()
+
+        q = 'create table if not exists refname(ref text primary key, name text, name_k text, expire int)'
+        self.cur.execute(q)
+        self.db.commit()
+
+    def get(self, ref):
+        e = self.lru.get(ref)
+        if not e:
+            self.cur.execute(
+                'select name, name_k, expire from refname where ref = ?', (ref,))
+            e = self.cur.fetchone()
+            if not e:
+                return None
+            self._remember(ref, e)
+        else:
+            self.lru.move_to_end(ref)
+        return e
+
+    def put(self, ref, name, name_k, now):
+        if name_k:
+            e = (name, name_k, now + self.ttl)
+        else:
+            e = (name, None, now + self.negative_ttl)
+        self.cur.execute(
+            'insert or replace into refname(ref, name, name_k, expire) values(?, ?, ?, ?)', (ref,) + e)
+        self.db.commit()
+        self._remember(ref, e)
+
+    def _remember(self, ref, e):
+        self.lru[ref] = e
+        self.lru.move_to_end(ref)
+        if len(self.lru) > self.size:
+            self.lru.popitem(last=False)
+
+    def load(self, fname, now):
+        with open(fname) as f:
+            refs = json.load(f)
+        q = 'insert or replace into refname(ref, name, name_k, expire) values(?, ?, ?, ?)'
+        self.cur.executemany(q, ((r.get('code', r.get('ref')), r['name'],
+                                  re.sub(r'\(.+\)|（.+）', '', r['name_k']), now + self.ttl)
+                                 for r in refs))
+        self.db.commit()
+        self.lru.clear()
+        return len(refs)
+
+    def close(self):
+        self.db.close()
+
+
+NOT_MODIFIED = object()
+
+
+class JSONArray:
+    decoder = json.JSONDecoder()
+    sep = re.compile(r'[\s,]*')
+
+    def __init__(self, text):
+        self.text = text
+        self.start = self.sep.match(text, text.index('[') + 1).end()
+        self.empty = text[self.start] == ']'
+        self.validator = None
+
+    def __bool__(self):
+        return not self.empty
+
+    def __iter__(self):
+        (text, i) = (self.text, self.start)
+        while text[i] != ']':
+            (obj, i) = self.decoder.raw_decode(text, i)
+            yield obj
+            i = self.sep.match(text, i).end()
+
+
+def spot_extractor(tr):
+    sid = operator.itemgetter(tr['id'])
+    if len(tr['ref']) == 1:
+        ref = operator.itemgetter(tr['ref'][0])
+    else:
+        refs = operator.itemgetter(*tr['ref'])
+        def ref(s): return '/'.join(refs(s))
+    fields = operator.itemgetter(tr['act'], tr['freq'], tr['mode'], tr['name'],
+                                 tr['loc'], tr['spotter'], tr['comments'], tr['time'])
+    def extract(s): return (ref(s),) + fields(s)
+    return (sid, ref, extract)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, dt, **labels):
+        k = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            t = self.timers.get(k)
+            if t:
+                t[0] += 1
+                t[1] += dt
+                t[2] = max(t[2], dt)
+            else:
+                self.timers[k] = [1, dt, dt]
+
+    def lap(self, stage, prog, t):
+        now = time.perf_counter()
+        self.observe('stage_seconds', now - t, stage=stage, prog=prog)
+        return now
+
+    def incr(self, name, n=1, **labels):
+        k = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[k] = self.counters.get(k, 0) + n
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def values(self):
+        with self.lock:
+            timers = list(self.timers.items())
+            counters = list(self.counters.items())
+            gauges = list(self.gauges.items())
+        for ((name, labels), (count, total, mx)) in timers:
+            yield (name + '_count', labels, count)
+            yield (name + '_sum', labels, total)
+            yield (name + '_max', labels, mx)
+        for ((name, labels), v) in counters:
+            yield (name, labels, v)
+        for ((name, labels), v) in gauges:
+            yield (name, labels, v() if callable(v) else v)
+
+    def snapshot(self):
+        res = {'time': int(time.time())}
+        for (name, labels, v) in self.values():
+            if labels:
+                res.setdefault(name, {})[
+                    ','.join(str(l) for (_, l) in labels)] = v
+            else:
+                res[name] = v
+        return res
+
+    def textfile(self, fname, prefix='mdspots'):
+        lines = []
+        for (name, labels, v) in self.values():
+            if labels:
+                lb = ','.join(f'{k}="{l}"' for (k, l) in labels)
+                lines.append(f'{prefix}_{name}{{{lb}}} {v}')
+            else:
+                lines.append(f'{prefix}_{name} {v}')
+        with open(fname + '.tmp', mode='w') as f:
+            print('\n'.join(lines), file=f)
+        os.replace(fname + '.tmp', fname)
+
+
+class Queries:
+    statements = {
+        'insert_spot': (
+            'insert into mdspots2(rowid, utc, time, prog, callsign, ref, name, freq, rawfreq, '
+            'mode, loc, region, comment, spotter, tweeted) '
+            'values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [], ''),
+        'suppress': (
+            'select callsign, ref, freq, mode, max(utc) from mdspots2 '
+            'where prog = ? and tweeted = 1 and utc > ?', [],
+            'group by callsign, ref, freq, mode'),
+        'logsearch': (
+            'select callsign, ref, time_in, time_out, freq_in, freq_out, mode_in, mode_out, '
+            'nfer, sota, loc from activations where prog = ? and last_utc > ?',
+            [('region', 'and region >= ? and region < ?'),
+             ('call', 'and callsign >= ? and callsign < ?'),
+             ('nfer', 'and (select max(nfers) from spotinfo i where i.prog = activations.prog '
+              'and i.callsign = activations.callsign and i.ref = activations.ref '
+              'and i.utc between activations.first_utc and activations.last_utc) = ?')],
+            'order by first_utc, rowid'),
+        'spotsearch': (
+            'select time, callsign, ref, freq, mode, comment from '
+            '(select utc, time, callsign, ref, freq, mode, comment, '
+            'row_number() over (partition by callsign, ref order by utc desc, rowid desc) as n '
+            'from mdspots2 where prog = ? and utc > ?',
+            [('region', 'and region = ?'),
+             ('call', 'and callsign >= ? and callsign < ?'),
+             ('maxfreq', 'and freq <= ?')],
+            ') where n = 1 order by utc desc'),
+        'stats': (
+            'select ref, callsign, count(*), sum(tweeted = 1) from mdspots2 '
+            'where prog = ? and utc > ? and utc < ?',
+            [('region', 'and region >= ? and region < ?'),
+             ('call', 'and callsign >= ? and callsign < ?'),
+             ('mode', 'and mode = ?')],
+            'group by ref, callsign order by min(utc)'),
+        'rollup_stats': (
+            'select ref, callsign, sum(spots), sum(tweeted) from rollup '
+            'where prog = ? and hour >= ?',
+            [('region', 'and region >= ? and region < ?'),
+             ('call', 'and callsign >= ? and callsign < ?'),
+             ('mode', 'and mode = ?')],
+            'group by ref, callsign order by min(hour), min(rowid)'),
+        'rollup_upsert': (
+            'insert into rollup(hour, prog, region, ref, callsign, mode, spots, tweeted) '
+            'values(?, ?, ?, ?, ?, ?, ?, ?) '
+            'on conflict(hour, prog, region, ref, callsign, mode) do update '
+            'set spots = spots + excluded.spots, tweeted = tweeted + excluded.tweeted', [], ''),
+        'rollup_horizon': ('select min(hour) from rollup where prog = ?', [], ''),
+        'horizon': ('select min(utc) from mdspots2 where prog = ?', [], ''),
+        'rollup_prune': ('delete from rollup where hour < ? and prog = ?', [], ''),
+        'prune': (
+            'delete from mdspots2 where rowid in '
+            '(select rowid from mdspots2 where utc < ? and prog = ? limit ?)', [], ''),
+    }
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.cache = {}
+
+    def bind(self, name, params, filters):
+        used = tuple(k for (k, _) in self.statements[name][1] if filters.get(k) is not None)
+        q = self.cache.get((name, used))
+        if q is None:
+            (head, clauses, tail) = self.statements[name]
+            q = ' '.join([head] + [c for (k, c) in clauses if k in used] + [tail]).rstrip()
+            self.cache[(name, used)] = q
+        params = list(params)
+        for k in used:
+            if isinstance(filters[k], tuple):
+                params.extend(filters[k])
+            else:
+                params.append(filters[k])
+        return (q, params)
+
+    @staticmethod
+    def prefix(p):
+        return (p, p[:-1] + chr(ord(p[-1]) + 1))
+
+    def run(self, cur, name, params=(), **filters):
+        (q, params) = self.bind(name, params, filters)
+        t = time.perf_counter()
+        rows = cur.execute(q, params).fetchall()
+        self.metrics.observe('query_seconds', time.perf_counter() - t, query=name)
+        return rows
+
+    def runmany(self, cur, name, seq):
+        (q, _) = self.bind(name, (), {})
+        t = time.perf_counter()
+        cur.executemany(q, seq)
+        self.metrics.observe('query_seconds', time.perf_counter() - t, query=name)
+        return cur.rowcount
+
+
+class SuppressIndex:
+    def __init__(self, interval):
+        self.interval = interval
+        self.last = {}
+
+    def warm(self, rows):
+        for (call, ref, freq, mode, utc) in rows:
+            self.last[(call, ref, freq, mode)] = utc
+
+    def seen(self, key, now):
+        t = self.last.get(key)
+        return t is not None and t > now - self.interval
+
+    def add(self, key, now):
+        self.last[key] = now
+
+    def prune(self, now):
+        expire = now - self.interval
+        self.last = {k: t for (k, t) in self.last.items() if t > expire}
+
+
+class Outbox:
+    def __init__(self, name, send, log, metrics, interval, retries, backoff):
+        self.name = name
+        self.send = send
+        self.log = log
+        self.metrics = metrics
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self.lastsent = 0
+        self.queue = queue.Queue()
+        self.metrics.set('queue_depth', self.queue.qsize, queue=name)
+        self.thread = threading.Thread(
+            target=self.run, name=f'outbox-{name}', daemon=True)
+        self.thread.start()
+
+    def post(self, prog, chain):
+        self.queue.put((prog, chain))
+
+    def close(self):
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            (prog, chain) = item
+            repl_id = None
+            for mesg in chain:
+                repl_id = self.deliver(prog, repl_id, mesg)
+
+    def deliver(self, prog, repl_id, mesg):
+        for i in range(self.retries + 1):
+            wait = self.lastsent + self.interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            t = time.perf_counter()
+            try:
+                res = self.send(prog, repl_id, mesg)
+                self.lastsent = time.monotonic()
+                self.metrics.observe('output_seconds', time.perf_counter() - t,
+                                     output=self.name)
+                self.metrics.incr('output_total', output=self.name, result='ok')
+                return res
+            except Exception as e:
+                self.lastsent = time.monotonic()
+                self.log(f'Warning:{self.name} {prog} {mesg} {e}')
+                if i < self.retries:
+                    self.metrics.incr('output_total', output=self.name, result='retry')
+                    time.sleep(self.backoff * 2 ** i)
+        self.metrics.incr('output_total', output=self.name, result='failed')
+        return None
+
+
+class CommentParser:
+    split = re.compile(r'[, :;]')
+    fer = re.compile(r'fer', re.IGNORECASE)
+    pota = re.compile(r'(\w+-\d\d\d\d)')
+    sota = re.compile(r'(\w+/\w+-\d+)')
+    loc = re.compile(r'([A-Z][A-Z]-\D+)')
+
+    def __init__(self, db):
+        self.db = db
+        self.cur = db.cursor()
+
+        q = 'create table if not exists spotinfo(spot integer primary key, utc int, prog text, ' \
+            'callsign text, ref text, nfer text, nfers int, sota text, loc text)'
+        self.cur.execute(q)
+        q = 'create index if not exists info_utc_index on spotinfo(utc, prog)'
+        self.cur.execute(q)
+        q = 'create index if not exists info_call_index on spotinfo(prog, callsign, ref, utc)'
+        self.cur.execute(q)
+
+    def parse(self, ref, comment):
+        (nfer, sota, loc) = ([], '', [])
+        isnfer = self.fer.search(comment)
+        for cm in self.split.split(comment):
+            m = self.pota.match(cm)
+            if isnfer and m:
+                ref2 = m.group(1)
+                if not 'FF' in ref2 and ref != ref2 and not ref2 in nfer:
+                    nfer.append(ref2)
+
+            m = self.sota.match(cm)
+            if m:
+                sota = m.group(1)
+
+            m = self.loc.match(cm)
+            if m:
+                if m.group(1) in loc:
+                    loc.remove(m.group(1))
+                loc.append(m.group(1))
+
+        if nfer or sota or loc:
+            return (nfer, sota, loc)
+        return None
+
+    def row(self, spot, utc, prog, call, ref, info):
+        (nfer, sota, loc) = info
+        return (spot, utc, prog, call, ref, '/'.join(nfer), len(nfer), sota, ','.join(loc))
+
+    def insert(self, rows):
+        q = 'insert or replace into spotinfo(spot, utc, prog, callsign, ref, nfer, nfers, sota, loc) ' \
+            'values(?, ?, ?, ?, ?, ?, ?, ?, ?)'
+        self.cur.executemany(q, rows)
+
+    def backfill(self):
+        (count,) = self.cur.execute('select count(*) from spotinfo').fetchone()
+        if count:
+            return 0
+        q = 'select rowid, utc, prog, callsign, ref, comment, spotter from mdspots2 order by rowid'
+        rows = []
+        for (spot, utc, prog, call, ref, comment, spotter) in self.cur.execute(q).fetchall():
+            if spotter and spotter in call and comment:
+                info = self.parse(ref, comment)
+                if info:
+                    rows.append(self.row(spot, utc, prog, call, ref, info))
+        self.insert(rows)
+        return len(rows)
+
+
+class Rollups:
+    def __init__(self, db, queries):
+        self.db = db
+        self.cur = db.cursor()
+        self.queries = queries
+        self.pending = {}
+
+        q = 'create table if not exists rollup(hour int, prog text, region text, ref text, ' \
+            'callsign text, mode text, spots int, tweeted int, ' \
+            'primary key(hour, prog, region, ref, callsign, mode))'
+        self.cur.execute(q)
+        q = 'create index if not exists rollup_prog_index on rollup(prog, hour, region, ' \
+            'callsign, mode, ref, spots, tweeted)'
+        self.cur.execute(q)
+
+    def backfill(self):
+        (count,) = self.cur.execute('select count(*) from rollup').fetchone()
+        if count:
+            return 0
+        q = 'insert into rollup(hour, prog, region, ref, callsign, mode, spots, tweeted) ' \
+            "select utc - utc % 3600, prog, coalesce(region, ''), ref, callsign, coalesce(mode, ''), " \
+            'count(*), sum(tweeted = 1) from mdspots2 group by 1, 2, 3, 4, 5, 6 order by min(rowid)'
+        self.cur.execute(q)
+        return self.cur.rowcount
+
+    def add(self, utc, prog, region, ref, call, mode, tweeted):
+        key = (utc - utc % 3600, prog, region or '', ref, call, mode or '')
+        c = self.pending.setdefault(key, [0, 0])
+        c[0] += 1
+        c[1] += tweeted
+
+    def flush(self):
+        self.queries.runmany(self.cur, 'rollup_upsert',
+                             (k + tuple(c) for (k, c) in self.pending.items()))
+        self.pending = {}
+
+    def prune(self, prog, before):
+        self.queries.run(self.cur, 'rollup_prune', (before - before % 86400, prog))
+        return self.cur.rowcount
+
+
+class Activations:
+    columns = ['prog', 'callsign', 'ref', 'region', 'first_utc', 'last_utc',
+               'time_in', 'time_out', 'freq_in', 'freq_out', 'mode_in', 'mode_out',
+               'lastmode', 'nfer', 'sota', 'loc']
+
+    def __init__(self, db, gap, freqstr):
+        self.db = db
+        self.cur = db.cursor()
+        self.gap = gap
+        self.freqstr = freqstr
+        self.sessions = {}
+        self.dirty = {}
+
+        q = 'create table if not exists activations(prog text, callsign text, ref text, region text, ' \
+            'first_utc int, last_utc int, time_in text, time_out text, freq_in text, freq_out text, ' \
+            'mode_in text, mode_out text, lastmode text, nfer text, sota text, loc text)'
+        self.cur.execute(q)
+        q = 'create index if not exists act_utc_index on activations(prog, last_utc)'
+        self.cur.execute(q)
+        q = 'create index if not exists act_call_index on activations(prog, callsign, ref, last_utc)'
+        self.cur.execute(q)
+
+    def load(self, now):
+        self.sessions = {}
+        q = 'select rowid, ' + ', '.join(self.columns) + \
+            ' from activations where last_utc > ? order by last_utc'
+        for r in self.cur.execute(q, (now - self.gap,)):
+            a = dict(zip(['rowid'] + self.columns, r))
+            a['nfer'] = a['nfer'].split('/') if a['nfer'] else []
+            a['loc'] = a['loc'].split(',') if a['loc'] else []
+            self.sessions[(a['prog'], a['callsign'], a['ref'])] = a
+
+    def rebuild(self):
+        (count,) = self.cur.execute('select count(*) from activations').fetchone()
+        if count:
+            return 0
+        q = 'select s.utc, s.time, s.prog, s.callsign, s.ref, s.freq, s.mode, s.region, ' \
+            'i.nfer, i.sota, i.loc from mdspots2 s left join spotinfo i on i.spot = s.rowid ' \
+            'order by s.rowid'
+        rows = self.cur.execute(q).fetchall()
+        for r in rows:
+            (nfer, sota, loc) = r[8:]
+            if nfer is None:
+                info = None
+            else:
+                info = (nfer.split('/') if nfer else [], sota, loc.split(',') if loc else [])
+            self.add(*r[:8], info)
+        self.flush()
+        return len(rows)
+
+    def add(self, utc, tm, prog, call, ref, freq, mode, region, info):
+        key = (prog, call, ref)
+        a = self.sessions.get(key)
+        if not a or a['last_utc'] < utc - self.gap:
+            a = {'rowid': None, 'prog': prog, 'callsign': call, 'ref': ref, 'region': region,
+                 'first_utc': utc, 'time_in': tm, 'time_out': None,
+                 'freq_in': self.freqstr(freq), 'freq_out': None,
+                 'mode_in': mode or None, 'mode_out': None, 'lastmode': mode or None,
+                 'nfer': [], 'sota': '', 'loc': []}
+            self.sessions[key] = a
+        else:
+            a['time_out'] = tm
+            a['freq_out'] = self.freqstr(freq)
+            if mode:
+                a['mode_out'] = mode
+                a['lastmode'] = mode
+                if not a['mode_in']:
+                    a['mode_in'] = mode
+            else:
+                a['mode_out'] = a['lastmode']
+        a['last_utc'] = utc
+
+        if info:
+            (nfer, sota, loc) = info
+            for ref2 in nfer:
+                if not ref2 in a['nfer']:
+                    a['nfer'].append(ref2)
+            if sota:
+                a['sota'] = sota
+            for code in loc:
+                if code in a['loc']:
+                    a['loc'].remove(code)
+                a['loc'].append(code)
+
+        self.dirty[key] = True
+
+    def flush(self):
+        updates = []
+        for key in self.dirty:
+            a = self.sessions[key]
+            r = [a[c] for c in self.columns]
+            r[self.columns.index('nfer')] = '/'.join(a['nfer'])
+            r[self.columns.index('loc')] = ','.join(a['loc'])
+            if a['rowid']:
+                updates.append(r + [a['rowid']])
+            else:
+                q = 'insert into activations(' + ', '.join(self.columns) + \
+                    ') values(' + ', '.join('?' * len(self.columns)) + ')'
+                self.cur.execute(q, r)
+                a['rowid'] = self.cur.lastrowid
+        q = 'update activations set ' + \
+            ', '.join(f'{c} = ?' for c in self.columns) + ' where rowid = ?'
+        self.cur.executemany(q, updates)
+        self.dirty = {}
+
+    def prune(self, now):
+        expire = now - self.gap
+        self.sessions = {k: a for (k, a) in self.sessions.items()
+                         if a['last_utc'] > expire}
+
+
+class SpotArchive:
+    numeric = {'utc': 'q', 'freq': 'd', 'tweeted': 'b'}
+    columns = ['utc', 'time', 'callsign', 'ref', 'name', 'freq', 'rawfreq', 'mode',
+               'loc', 'region', 'comment', 'spotter', 'tweeted']
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def path(self, prog, day):
+        d = datetime.fromtimestamp(day * 86400, timezone.utc).strftime('%Y%m%d')
+        return os.path.join(self.dirname, prog, d + '.zip')
+
+    def write(self, prog, day, rows):
+        fname = self.path(prog, day)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with zipfile.ZipFile(fname + '.tmp', 'w', zipfile.ZIP_DEFLATED) as z:
+            for (c, col) in zip(self.columns, zip(*rows)):
+                if c in self.numeric:
+                    z.writestr(c, array.array(self.numeric[c], (v or 0 for v in col)).tobytes())
+                else:
+                    words = list(dict.fromkeys(col))
+                    codes = {w: i for (i, w) in enumerate(words)}
+                    z.writestr(c + '.dict', json.dumps(words))
+                    z.writestr(c, array.array('I', (codes[w] for w in col)).tobytes())
+        os.replace(fname + '.tmp', fname)
+
+    def export(self, cur, prog, cutoff):
+        q = 'select ' + ', '.join(self.columns) + \
+            ' from mdspots2 where utc >= ? and utc < ? and prog = ? order by utc, rowid'
+        (first,) = cur.execute(
+            'select min(utc) from mdspots2 where utc < ? and prog = ?', (cutoff, prog)).fetchone()
+        if first is None:
+            return 0
+        count = 0
+        for day in range(first // 86400, cutoff // 86400):
+            if os.path.exists(self.path(prog, day)):
+                continue
+            rows = cur.execute(q, (day * 86400, (day + 1) * 86400, prog)).fetchall()
+            if rows:
+                self.write(prog, day, rows)
+                count += len(rows)
+        return count
+
+    def column(self, z, c):
+        if c in self.numeric:
+            return array.array(self.numeric[c], z.read(c))
+        words = json.loads(z.read(c + '.dict'))
+        return (words, array.array('I', z.read(c)))
+
+    def scan(self, prog, since, until, columns, match=None):
+        match = match or {}
+        cols = list(dict.fromkeys(['utc'] + list(match) + list(columns)))
+        for day in range(since // 86400, until // 86400 + 1):
+            fname = self.path(prog, day)
+            if not os.path.exists(fname):
+                continue
+            with zipfile.ZipFile(fname) as z:
+                data = {c: self.column(z, c) for c in cols}
+
+            utc = data['utc']
+            sel = [i for i in range(len(utc)) if since <= utc[i] < until]
+            for (c, m) in match.items():
+                if c in self.numeric:
+                    col = data[c]
+                    sel = [i for i in sel if m(col[i])]
+                else:
+                    (words, codes) = data[c]
+                    ok = {n for (n, w) in enumerate(words) if m(w)}
+                    sel = [i for i in sel if codes[i] in ok]
+
+            out = []
+            for c in columns:
+                if c in self.numeric:
+                    col = data[c]
+                    out.append([col[i] for i in sel])
+                else:
+                    (words, codes) = data[c]
+                    out.append([words[codes[i]] for i in sel])
+            yield from zip(*out)
+
+    def counts(self, prog, since, until, match=None):
+        counts = {}
+        for (ref, call, tweeted) in self.scan(prog, since, until,
+                                              ['ref', 'callsign', 'tweeted'], match):
+            c = counts.setdefault((ref, call), [0, 0])
+            c[0] += 1
+            c[1] += tweeted
+        return [(ref, call, n, t) for ((ref, call), (n, t)) in counts.items()]
+
+    @staticmethod
+    def prefix(p):
+        return lambda w: bool(w) and w.startswith(p)
+
+
+class FeedFetcher:
+    def __init__(self, endpoints, metrics, timeout, connect_timeout, workers, conditional=('spots',)):
+        self.endpoints = endpoints
+        self.metrics = metrics
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.conditional = conditional
+        self.sessions = {}
+        self.validators = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+        self.encoding = 'gzip, deflate'
+        if importlib.util.find_spec('brotli'):
+            self.encoding += ', br'
+
+    def session(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                import requests
+                self.sessions[host] = requests.Session()
+            return self.sessions[host]
+
+    def url(self, prog, ty, param=None):
+        if not param:
+            param = urllib.parse.urlencode(self.endpoints[prog]['client'])
+        else:
+            param = urllib.parse.urlencode({'refid': param})
+        return self.endpoints[prog][ty] + param
+
+    def get(self, prog, ty, param=None):
+        url = self.url(prog, ty, param)
+        headers = {'Accept-Encoding': self.encoding}
+
+        t = time.perf_counter()
+        stream = ty == 'spots' and self.endpoints[prog].get('order') == 'desc'
+        if param or ty not in self.conditional:
+            res = self.session(url).get(url, headers=headers,
+                                        timeout=(self.connect_timeout, self.timeout))
+            res.raise_for_status()
+            body = res.content
+            t = self.metrics.lap('fetch', prog, t)
+            data = json.loads(body)
+            self.metrics.lap('parse', prog, t)
+            return data
+
+        v = self.validators.get(url, {})
+        if v.get('etag'):
+            headers['If-None-Match'] = v['etag']
+        if v.get('last_modified'):
+            headers['If-Modified-Since'] = v['last_modified']
+
+        res = self.session(url).get(url, headers=headers,
+                                    timeout=(self.connect_timeout, self.timeout))
+        st = self.stats.setdefault(f'{prog}/{ty}', {
+            'requests': 0, 'not_modified': 0, 'unchanged': 0,
+            'bytes': 0, 'bytes_saved': 0, 'parse_time': 0.0, 'parse_saved': 0.0})
+        st['requests'] += 1
+
+        if res.status_code == 304:
+            st['not_modified'] += 1
+            st['bytes_saved'] += v.get('size', 0)
+            st['parse_saved'] += v.get('parse_time', 0.0)
+            return NOT_MODIFIED
+
+        res.raise_for_status()
+        body = res.content
+        size = res.raw.tell() or len(body)
+        self.metrics.lap('fetch', prog, t)
+        st['bytes'] += size
+
+        digest = hashlib.sha1(body).digest()
+        if digest == v.get('hash'):
+            st['unchanged'] += 1
+            st['parse_saved'] += v.get('parse_time', 0.0)
+            return NOT_MODIFIED
+
+        t = time.perf_counter()
+        data = JSONArray(body.decode()) if stream else json.loads(body)
+        parse_time = time.perf_counter() - t
+        st['parse_time'] += parse_time
+        self.metrics.observe('stage_seconds', parse_time, stage='parse', prog=prog)
+
+        v = {'etag': res.headers.get('ETag'),
+             'last_modified': res.headers.get('Last-Modified'),
+             'hash': digest, 'size': size, 'parse_time': parse_time}
+        if stream:
+            data.validator = (url, v)
+        else:
+            self.validators[url] = v
+        return data
+
+    def accept(self, data):
+        if data.validator:
+            (url, v) = data.validator
+            self.validators[url] = v
+
+    def report(self):
+        return [f"{k}: {st['requests']} requests, {st['not_modified']} not modified, "
+                f"{st['unchanged']} unchanged, {st['bytes']} bytes, {st['bytes_saved']} bytes saved, "
+                f"parse {st['parse_time']:.3f}s, {st['parse_saved']:.3f}s saved"
+                for (k, st) in self.stats.items()]
+
+    def get_all(self, jobs):
+        futures = {self.pool.submit(self.get, *j): j for j in jobs}
+        (_, pending) = wait(futures, timeout=self.timeout + self.connect_timeout)
+
+        result = {}
+        for (f, j) in futures.items():
+            if f in pending:
+                f.cancel()
+                result[j] = TimeoutError(f'Deadline exceeded {self.url(*j)}')
+            elif f.exception():
+                result[j] = f.exception()
+            else:
+                result[j] = f.result()
+        return result
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        for s in self.sessions.values():
+            s.close()
+
+
+class PollScheduler:
+    def __init__(self, programs, config, endpoints):
+        now = time.monotonic()
+        self.plan = {}
+        for p in programs:
+            interval = config['interval']
+            self.plan[p] = {'interval': interval,
+                            'min': config[p].get('min_interval', interval),
+                            'max': config[p].get('max_interval', interval),
+                            'gap': endpoints[p].get('min_poll', 0),
+                            'due': now}
+
+    def due(self, now):
+        return [p for (p, pl) in self.plan.items() if pl['due'] <= now]
+
+    def next_due(self):
+        return min(pl['due'] for pl in self.plan.values())
+
+    def update(self, prog, result, now):
+        pl = self.plan[prog]
+        if result is None:
+            pl['interval'] = min(pl['max'], pl['interval'] * 2)
+        elif result > 0:
+            pl['interval'] = max(pl['min'], pl['interval'] / 2)
+        else:
+            pl['interval'] = min(pl['max'], pl['interval'] * 1.5)
+        pl['due'] = now + max(pl['interval'], pl['gap'])
+        return pl['interval']
+
 
-import tweepy
-from mastodon import Mastodon
-from nostr.event import Event
-from nostr.relay_manager import RelayManager
-from nostr.message_type import ClientMessageType
-from nostr.key import PrivateKey
+class QueryHandler(socketserver.StreamRequestHandler):
+    timeout = 10
+
+    def handle(self):
+        try:
+            cmd = self.rfile.readline().decode().strip()
+        except OSError as e:
+            self.server.spotter.log(f'Warning:{e} query')
+            return
+        try:
+            mesg = self.server.spotter.interp(cmd)
+        except Exception as e:
+            mesg = f'Error:{e}'
+            self.server.spotter.log(f'Error:{e} query "{cmd}"')
+        self.wfile.write(mesg.encode())
+
+
+def query(sockname, cmd, timeout=10):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(sockname)
+        s.sendall(cmd.encode() + b'\n')
+        s.shutdown(socket.SHUT_WR)
+        res = b''
+        while True:
+            r = s.recv(65536)
+            if not r:
+                break
+            res += r
+    return res.decode()
 
 
 class MDSpotter:
+    schema = ['mdspots2', 'activations', 'spotinfo', 'rollup']
+
     def __init__(self, **args):
 
         self.programs = args.get('programs', None)
@@ -34,6 +1060,8 @@ class MDSpotter:
         self.config = args.get('config', None)
         self.endpoints = args.get('endpoints', None)
 
+        self.readonly = args.get('readonly', False)
+
         self.localtz = pytz.timezone(self.config['localtz'])
 
         self.lastid = {}
@@ -41,186 +1069,304 @@ class MDSpotter:
         self.mdapi = {}
         self.ntpriv_key = {}
         self.ntrelay = None
+        self.outbox = {}
+        self.fanout = None
+        self.metrics = Metrics()
+        self.queries = Queries(self.metrics)
+
+        self.logger = Logger(self.config['logdir'] + self.config['logname'],
+                             self.config.get('log_buffer', 10000),
+                             self.config.get('log_max_bytes', 0),
+                             self.config.get('log_rotate', ''),
+                             self.config.get('log_backups', 7),
+                             self.config.get('log_verbosity', {}))
+        self.metrics.set('queue_depth', self.logger.queue.qsize, queue='log')
+        self.metrics.set('log_dropped', lambda: self.logger.dropped)
 
         for p in self.programs:
-            if self.accesskeys[p]['bearer']:
-                k = self.accesskeys[p]
-                self.twapi[p] = tweepy.Client(
-                    bearer_token=k['bearer'],
-                    consumer_key=k['consumer'],
-                    consumer_secret=k['consumer_sec'],
-                    access_token=k['access'],
-                    access_token_secret=k['access_sec'])
-            else:
-                self.twapi[p] = None
-
-            if self.accesskeys[p]['mastodon_access_token']:
-                k = self.accesskeys[p]
-                self.mdapi[p] = Mastodon(access_token=k['mastodon_access_token'],
-                                         api_base_url=k['mastodon_api_base_url']
-                                         )
-            else:
-                self.mdapi[p] = None
+            self.lastid[p] = 0
 
-            if self.accesskeys[p]['nostr_private_key']:
-                self.ntpriv_key[p] = PrivateKey.from_nsec(
-                    self.accesskeys[p]['nostr_private_key'])
-                if not self.ntrelay:
-                    self.ntrelay = RelayManager()
-                    for r in self.config['nostr_relay_servers']:
-                        self.ntrelay.add_relay(
-                            r, ssl_options={"cert_reqs": ssl.CERT_NONE})
-            else:
-                self.ntpriv_key[p] = None
+        self.dbname = self.config['homedir'] + 'mdspots.db'
+        self.dbtimeout = self.config.get('db_timeout', 10)
+        self.readers = threading.local()
+        self.now = int(datetime.utcnow().strftime("%s"))
 
-            self.lastid[p] = 0
+        archive_dir = self.config.get('archive_dir', self.config['homedir'] + 'archive/')
+        self.archive = SpotArchive(archive_dir) if archive_dir else None
 
-        def mqtt_onconnect(client, userdata, flags, rc):
-            if rc == 0:
-                self.log("Connected to MQTT Broker")
-            else:
-                self.log("Failed to connect MQTT Broker rc={rc}")
+        if self.readonly:
+            self.check_schema()
+            return
 
-        self.mqtt = mqtt.Client('SOTA-POTA-SpotService')
-        self.mqtt.username_pw_set(
-            self.config['mqttuser'], self.config['mqttpasswd'])
-        if self.config['mqttcert']:
-            self.mqtt.tls_set(ca_certs=self.config['mqttcert'])
-        self.mqtt.on_connect = mqtt_onconnect
-        self.mqtt.connect(self.config['mqttbroker'], self.config['mqttport'])
-        self.mqtt.loop_start()
+        self.mqtt = None
+        if any(self.config[p]['enable_mqtt'] for p in self.programs):
+            self.mqtt_connect()
 
-        self.db = sqlite3.connect(self.config['homedir'] + 'mdspots.db')
+        self.db = sqlite3.connect(self.dbname, timeout=self.dbtimeout)
+        self.db.execute('pragma journal_mode = wal')
         self.cur = self.db.cursor()
-        self.cur2 = self.db.cursor()
-        self.now = int(datetime.utcnow().strftime("%s"))
 
         self.mqttdb = sqlite3.connect(self.config['mqttdb'])
-        self.mqttcur = self.mqttdb.cursor()
+        self.potalog = PotaLogCache(self.mqttdb)
+
+        self.fetcher = FeedFetcher(self.endpoints, self.metrics,
+                                   self.config.get('fetch_timeout', 20),
+                                   self.config.get('fetch_connect_timeout', 5),
+                                   self.config.get('fetch_workers', 4))
+
+        self.refnames = RefNameCache(self.config['homedir'] + 'refname.db',
+                                     self.config.get('refname_ttl', 30 * 86400),
+                                     self.config.get('refname_negative_ttl', 86400),
+                                     self.config.get('refname_cache_size', 1024))
+        if self.config.get('refname_dump'):
+            try:
+                n = self.refnames.load(self.config['refname_dump'], self.now)
+                self.log(f"Loaded {n} reference names from {self.config['refname_dump']}")
+            except Exception as e:
+                self.log(f"Warning:{e} {self.config['refname_dump']}")
 
         q = 'create table if not exists mdspots2(utc int, time text, prog text, callsign text, ' \
             'ref txt, name text, freq real, rawfreq text, mode text, loc text, region text, comment text, spotter text, tweeted int)'
         self.cur.execute(q)
-        q = 'create index if not exists md_reg_index on mdspots2(utc, prog, region)'
+        for i in ['md_reg_index', 'md_ref_index', 'md_call_index']:
+            self.cur.execute(f'drop index if exists {i}')
+        q = 'create index if not exists md_prog_index on mdspots2(prog, utc)'
         self.cur.execute(q)
-        q = 'create index if not exists md_ref_index on mdspots2(utc, ref)'
+        q = 'create index if not exists md_region_index on mdspots2(prog, region, utc)'
         self.cur.execute(q)
-        q = 'create index if not exists md_call_index on mdspots2(utc, callsign)'
+        q = 'create index if not exists md_callsign_index on mdspots2(prog, callsign, utc)'
+        self.cur.execute(q)
+
+        self.comments = CommentParser(self.db)
+        n = self.comments.backfill()
+        if n:
+            self.log(f'Extracted comment references from {n} spots.')
+        (self.spotrow,) = self.cur.execute('select max(rowid) from mdspots2').fetchone()
+        self.spotrow = self.spotrow or 0
+
+        self.rollups = Rollups(self.db, self.queries)
+        n = self.rollups.backfill()
+        if n:
+            self.log(f'Built {n} hourly rollups from stored spots.')
+
+        self.activations = Activations(self.db, self.config.get('session_gap', 6 * 3600),
+                                       self.freqstr)
+        n = self.activations.rebuild()
+        if n:
+            self.log(f'Rebuilt activations from {n} spots.')
+        self.activations.load(self.now)
+
+        q = 'create table if not exists cursors(name text primary key, value)'
         self.cur.execute(q)
 
         self.db.commit()
         self.loadLastId()
 
+        self.extractors = {p: spot_extractor(self.translates['spots'][p])
+                           for p in self.programs}
+
+        self.suppress = {}
+        for p in self.programs:
+            self.suppress[p] = SuppressIndex(self.config[p]['suppress_interval'])
+            self.suppress[p].warm(self.queries.run(
+                self.cur, 'suppress', (p, self.now - self.config[p]['suppress_interval'])))
+
     def __del__(self):
+        if getattr(self.readers, 'db', None):
+            self.readers.db.close()
+        if self.readonly:
+            return
+
         self.db.commit()
         self.db.close()
+        self.refnames.close()
+        self.fetcher.close()
+
+        for o in self.outbox.values():
+            o.close()
 
         if self.ntrelay:
             self.ntrelay.close_all_relay_connections()
 
-    def saveLastId(self):
-        with open(self.config['homedir'] + 'lastid.pkl', mode='wb') as f:
-            pickle.dump(self.lastid, f)
+    def reader(self):
+        db = getattr(self.readers, 'db', None)
+        if not db:
+            db = sqlite3.connect('file:' + urllib.parse.quote(self.dbname) + '?mode=ro',
+                                 uri=True, timeout=self.dbtimeout)
+            self.readers.db = db
+        return db
+
+    def check_schema(self):
+        names = {n for (n,) in self.reader().execute('select name from sqlite_master')}
+        missing = [n for n in self.schema if n not in names]
+        if missing:
+            raise RuntimeError(f"{self.dbname} has no {', '.join(missing)}; "
+                               "start the server once to update it.")
+
+    def setCursor(self, name, value):
+        self.cursors[name] = value
+        self.cur.execute(
+            'insert or replace into cursors(name, value) values(?, ?)', (name, value))
+
+    def saveLastId(self, prog):
+        self.setCursor(f'lastid/{prog}', self.lastid[prog])
 
     def loadLastId(self):
-        try:
-            with open(self.config['homedir'] + 'lastid.pkl', mode='rb') as f:
-                saved = pickle.load(f)
-                for p in self.programs:
-                    self.lastid[p] = saved[p]
-        except Exception as e:
-            self.log("Info: lastid.pkl not found.")
+        self.cursors = dict(self.cur.execute('select name, value from cursors'))
+        if not self.cursors:
+            try:
+                with open(self.config['homedir'] + 'lastid.pkl', mode='rb') as f:
+                    saved = pickle.load(f)
+                    for p in self.programs:
+                        self.lastid[p] = saved[p]
+                        self.saveLastId(p)
+                self.db.commit()
+                self.log("Info: lastid.pkl imported.")
+            except Exception as e:
+                self.log("Info: lastid.pkl not found.")
 
-    def log(self, mesg):
-        now = datetime.now()
-        with open(self.config['logdir'] + self.config['logname'], mode='a') as f:
-            print(f'{now}: {mesg}', file=f)
+        for p in self.programs:
+            self.lastid[p] = self.cursors.get(f'lastid/{p}', 0)
+
+    def log(self, mesg, cat='main'):
+        self.logger.log(mesg, cat)
+
+    def mqtt_connect(self):
+        from paho.mqtt import client as mqtt
+
+        def mqtt_onconnect(client, userdata, flags, rc):
+            if rc == 0:
+                self.log("Connected to MQTT Broker")
+            else:
+                self.log("Failed to connect MQTT Broker rc={rc}")
+
+        self.mqtt = mqtt.Client('SOTA-POTA-SpotService')
+        self.mqtt.username_pw_set(
+            self.config['mqttuser'], self.config['mqttpasswd'])
+        if self.config['mqttcert']:
+            self.mqtt.tls_set(ca_certs=self.config['mqttcert'])
+        self.mqtt.on_connect = mqtt_onconnect
+        self.mqtt.max_queued_messages_set(self.config.get('mqtt_max_queued', 0))
+        self.mqtt.connect(self.config['mqttbroker'], self.config['mqttport'])
+        self.mqtt.loop_start()
+
+    def twitter(self, prog):
+        if prog not in self.twapi:
+            k = self.accesskeys[prog]
+            if k['bearer']:
+                import tweepy
+                self.twapi[prog] = tweepy.Client(
+                    bearer_token=k['bearer'],
+                    consumer_key=k['consumer'],
+                    consumer_secret=k['consumer_sec'],
+                    access_token=k['access'],
+                    access_token_secret=k['access_sec'])
+            else:
+                self.twapi[prog] = None
+        return self.twapi[prog]
+
+    def mastodon(self, prog):
+        if prog not in self.mdapi:
+            k = self.accesskeys[prog]
+            if k['mastodon_access_token']:
+                from mastodon import Mastodon
+                self.mdapi[prog] = Mastodon(access_token=k['mastodon_access_token'],
+                                            api_base_url=k['mastodon_api_base_url']
+                                            )
+            else:
+                self.mdapi[prog] = None
+        return self.mdapi[prog]
+
+    def nostr(self, prog):
+        if prog not in self.ntpriv_key:
+            k = self.accesskeys[prog]
+            if k['nostr_private_key']:
+                from nostr.key import PrivateKey
+                from nostr.relay_manager import RelayManager
+                self.ntpriv_key[prog] = PrivateKey.from_nsec(
+                    k['nostr_private_key'])
+                if not self.ntrelay:
+                    self.ntrelay = RelayManager()
+                    for r in self.config['nostr_relay_servers']:
+                        self.ntrelay.add_relay(
+                            r, ssl_options={"cert_reqs": ssl.CERT_NONE})
+            else:
+                self.ntpriv_key[prog] = None
+        return self.ntpriv_key[prog]
 
     def mqtt_publish(self, topic, mesg):
         res = self.mqtt.publish(topic, mesg)
-        self.log(f"MQTTPublish({res}): {mesg} to {topic}")
+        self.metrics.incr('output_total', output='mqtt',
+                          result='failed' if res.rc else 'ok')
+        self.log(f"MQTTPublish({res}): {mesg} to {topic}", 'mqtt')
 
     def mqtt_publish_client(self, topic, mesg_json):
         mesg_json['qso'] = 0
         mesg_json['qsod'] = ""
         mesg = json.dumps(mesg_json)
         res = self.mqtt.publish('js/'+ topic, mesg)
-        self.log(f"MQTTPublish({res}): {mesg} to js/{topic}")
-
-        self.mqttcur.execute('select * from mqttuser')
-        mqttuser = self.mqttcur.fetchall()
-
-        for (uuid, time) in mqttuser:
-            ref = mesg_json['refid']
-            q = 'select * from potalog where uuid = ? and ref = ?'
-            self.mqttcur.execute(q, (uuid, ref,))
-            r = self.mqttcur.fetchall()
-            mesg_json['qso'] = len(r)
-            if len(r):
-                mesg_json['qsod'] = r[0][4]
-            else:
-                mesg_json['qsod'] = ''
-            mesg = json.dumps(mesg_json)
-            res = self.mqtt.publish(uuid + '/' + topic, mesg)
-            self.log(f"MQTTPublish({res}): {mesg} to {uuid}/{topic}")
+        self.log(f"MQTTPublish({res}): {mesg} to js/{topic}", 'mqtt')
+
+        self.potalog.refresh()
+        ref = mesg_json['refid']
+
+        if not self.fanout:
+            self.fanout = Fanout(self.mqtt.publish, self.log, self.metrics,
+                                 self.config.get('fanout_workers', 4),
+                                 self.config.get('fanout_queue', 100))
+
+        payloads = {(0, ''): mesg}
+        shards = [[] for _ in self.fanout.queues]
+        shard = self.fanout.shard
+        for uuid in self.potalog.users:
+            qso = tuple(self.potalog.lookup(uuid, ref))
+            if qso not in payloads:
+                (mesg_json['qso'], mesg_json['qsod']) = qso
+                payloads[qso] = json.dumps(mesg_json)
+            shards[shard(uuid)].append((uuid, payloads[qso]))
+
+        self.fanout.submit(topic, (mesg_json['act'], ref), shards)
 
         
     def tweet_as_reply(self, prog, repl_id, mesg):
 
-        if not self.twapi[prog]:
+        if not self.twitter(prog):
             self.log(f"Tweet {prog} ={mesg}")
             return None
 
         if not repl_id:
-            try:
-                res = self.twapi[prog].create_tweet(text=mesg)
-                self.log(f'Spotted: {mesg}')
-            except Exception as e:
-                self.log(f'Warning: {prog} {mesg} : {e}')
-                return None
+            res = self.twapi[prog].create_tweet(text=mesg)
         else:
-            try:
-                res = self.twapi[prog].create_tweet(
-                    text=mesg, in_reply_to_tweet_id=repl_id['id'])
-                self.log(f'Spotted: {mesg}')
-            except Exception as e:
-                self.log(f'Warning:{prog} {mesg} {e}')
-                return None
+            res = self.twapi[prog].create_tweet(
+                text=mesg, in_reply_to_tweet_id=repl_id['id'])
+        self.log(f'Spotted: {mesg}')
 
         return res.data
 
     def toot_as_reply(self, prog, repl_id, mesg):
 
-        if not self.mdapi[prog]:
+        if not self.mastodon(prog):
             self.log(f"Toot={mesg}")
             return None
 
         if not repl_id:
-            try:
-                res_md = self.mdapi[prog].status_post(mesg)
-                self.log(f'SpottedMD: {mesg}')
-            except Exception as e:
-                self.log(f'ErrorMD: {e}')
-                res_md = None
+            res_md = self.mdapi[prog].status_post(mesg)
         else:
-            try:
-                res_md = self.mdapi[prog].status_post(
-                    mesg, in_reply_to_id=repl_id['id'])
-                self.log(f'SpottedMD: {mesg}')
-            except Exception as e:
-                self.log(f'ErrorMD: {e}')
-                res_md = None
+            res_md = self.mdapi[prog].status_post(
+                mesg, in_reply_to_id=repl_id['id'])
+        self.log(f'SpottedMD: {mesg}')
 
         return res_md
 
     def post_nostr_event(self, prog, repl_id, mesg):
-        if not self.ntpriv_key[prog]:
+        if not self.nostr(prog):
             self.log(f"Nostr({prog})={mesg}")
             return None
 
         res_nostr = None
 
         if self.ntrelay:
+            from nostr.event import Event
             event = Event(mesg)
             if repl_id:
                 event.add_event_ref(repl_id)
@@ -228,10 +1374,33 @@ class MDSpotter:
             self.ntpriv_key[prog].sign_event(event)
             res_nostr = event.id
             self.ntrelay.publish_event(event)
-            time.sleep(1)
 
         return res_nostr
 
+    def post(self, channel, prog, chain):
+        if channel not in self.outbox:
+            send = {'tweet': self.tweet_as_reply,
+                    'toot': self.toot_as_reply,
+                    'nostr': self.post_nostr_event}[channel]
+            interval = self.config.get('outbox_interval', {}).get(
+                channel, 1 if channel == 'nostr' else 0)
+            self.outbox[channel] = Outbox(channel, send, self.log, self.metrics, interval,
+                                          self.config.get('outbox_retries', 3),
+                                          self.config.get('outbox_backoff', 5))
+        self.outbox[channel].post(prog, chain)
+
+    def chunks(self, mesg, limit):
+        res = []
+        tm = ''
+        for m in mesg.splitlines():
+            if len(tm + m) > limit:
+                res.append(tm.rstrip())
+                tm = m + '\n'
+            else:
+                tm += m + '\n'
+        res.append(tm.rstrip())
+        return res
+
     def close_connection(self):
         if self.ntrelay:
             self.ntrelay.close_connections()
@@ -241,34 +1410,64 @@ class MDSpotter:
     def getJSON(self, prog, ty, param=None):
         if self.endpoints[prog][ty]:
             try:
-                if not param:
-                    param = urllib.parse.urlencode(
-                        self.endpoints[prog]['client'])
-                else:
-                    param = urllib.parse.urlencode({'refid': param})
-
-                readObj = urllib.request.urlopen(
-                    self.endpoints[prog][ty] + param)
-                res = readObj.read()
-                return json.loads(res)
+                return self.fetcher.get(prog, ty, param)
             except Exception as e:
                 self.log(f'Error:{e} {self.endpoints[prog][ty]}')
                 raise e
 
+    def getJSON_all(self, jobs):
+        jobs = [j for j in jobs if self.endpoints[j[0]][j[1]]]
+        result = self.fetcher.get_all(jobs)
+        for (j, r) in result.items():
+            if isinstance(r, Exception):
+                self.log(f'Error:{r} {self.endpoints[j[0]][j[1]]}')
+        return result
+
+    def prefetch_refnames(self, refs):
+        now = int(time.time())
+        misses = set()
+        for ref in refs:
+            if re.match(r'JA.*', ref):
+                cached = self.refnames.get(ref)
+                if not cached or cached[2] <= now:
+                    misses.add(ref)
+
+        if len(misses) > 1:
+            for ((_, _, ref), res) in self.getJSON_all(
+                    ('sotalive', 'getref', r) for r in misses).items():
+                if not isinstance(res, Exception):
+                    self.refnames.put(ref, *self.refname_result(ref, res), now)
+
     def refNamequery(self, refid):
         m = re.match(r'JA.*', refid)
         if m:
-            res = self.getJSON('sotalive', 'getref', refid)
-            if res['counts'] == 0:
-                return (refid, None)
-            else:
-                name = res['reference'][0]['name']
-                name_k = re.sub(r'\(.+\)|（.+）', '',
-                                res['reference'][0]['name_k'])
-                return (name, name_k)
+            now = int(time.time())
+            cached = self.refnames.get(refid)
+            if cached and cached[2] > now:
+                return cached[:2]
+
+            try:
+                res = self.getJSON('sotalive', 'getref', refid)
+            except Exception as e:
+                if cached:
+                    return cached[:2]
+                raise e
+
+            (name, name_k) = self.refname_result(refid, res)
+            self.refnames.put(refid, name, name_k, now)
+            return (name, name_k)
         else:
             return (refid, None)
 
+    def refname_result(self, refid, res):
+        if res['counts'] == 0:
+            return (refid, None)
+        else:
+            name = res['reference'][0]['name']
+            name_k = re.sub(r'\(.+\)|（.+）', '',
+                            res['reference'][0]['name_k'])
+            return (name, name_k)
+
     def freqstr(self, f):
         if f < 4000:
             s = f"{f/1000:.1f}"
@@ -286,78 +1485,24 @@ class MDSpotter:
         else:
             return f"Activation summary for the last {t} hour{pl(t)}: No activation."
 
-    def logsearch(self, prog, region, locpfx, call, twindow):
-        lastseen = self.now - twindow
+    def logsearch(self, prog, region, locpfx, call, twindow, now=None, nfer=None):
+        lastseen = (now or self.now) - twindow
         mesg = ''
         references = set()
         stations = set()
 
-        if region:
-            q_reg = f"region like '{region}%' and"
-        else:
-            q_reg = ""
+        rows = self.queries.run(self.reader(), 'logsearch', (prog, lastseen),
+                                region=Queries.prefix(region) if region else None,
+                                call=Queries.prefix(call) if call else None,
+                                nfer=nfer - 1 if nfer else None)
 
-        if call:
-            q_call = f"callsign like '{call}%' and"
-        else:
-            q_call = ""
-
-        q = f"select distinct callsign, ref from mdspots2 where prog = '{prog}' and {q_reg} {q_call} utc > {lastseen}"
-
-        for i in self.cur.execute(q):
-            (call, ref) = i
-            time_in, mode_in, freq_in = None, None, None
-            time_out, mode_out, freq_out = None, None, None
-            nfer = []
-            sota = ''
-            mloc = ''
-            lastmode = None
-
-            q = f"select time, freq, mode, comment, spotter from mdspots2 where prog = '{prog}' and callsign = '{call}' and ref = '{ref}' and utc > {lastseen}"
-
-            for j in self.cur2.execute(q):
-                (tm, freq, mode, comment, spotter) = j
-                if spotter and spotter in call:
-                    if comment:
-                        cmlist = re.split(r'[, :;]', comment)
-                        isnfer = re.search(r'fer', comment, re.IGNORECASE)
-                    else:
-                        cmlist = []
-                        isnfer = None
-
-                    for cm in cmlist:
-                        m = re.match(r'(\w+-\d\d\d\d)', cm)
-                        if isnfer and m:
-                            ref2 = m.group(1)
-                            if not 'FF' in ref2 and ref != ref2 and not ref2 in nfer:
-                                nfer.append(ref2)
-                                references.add(ref2)
-
-                        m = re.match(r'(\w+/\w+-\d+)', cm)
-                        if m:
-                            sota = m.group(1)
-
-                        if locpfx:
-                            m = re.match(f"({locpfx}-\D+)", cm)
-                            if m:
-                                mloc = m.group(1)
-
-                if not time_in:
-                    time_in = tm
-                    freq_in = self.freqstr(freq)
-                    if mode:
-                        mode_in = mode
-                        lastmode = mode
-                else:
-                    time_out = tm
-                    freq_out = self.freqstr(freq)
-                    if mode:
-                        mode_out = mode
-                        lastmode = mode
-                        if not mode_in:
-                            mode_in = mode
-                    else:
-                        mode_out = lastmode
+        for i in rows:
+            (call, ref, time_in, time_out, freq_in, freq_out,
+             mode_in, mode_out, nfer, sota, mloc) = i
+            nfer = nfer.split('/') if nfer else []
+            references.update(nfer)
+            codes = [c for c in (mloc or '').split(',') if locpfx and c.startswith(locpfx + '-')]
+            mloc = codes[-1] if codes else ''
 
             if not mode_in:
                 mode_in = '*'
@@ -393,34 +1538,17 @@ class MDSpotter:
 
         return (len(stations), len(references), mesg)
 
-    def spotsearch(self, prog, region, call, maxfreq, twindow):
-        lastseen = self.now - twindow
+    def spotsearch(self, prog, region, call, maxfreq, twindow, now=None):
+        lastseen = (now or self.now) - twindow
         mesg = ''
         count = 0
+        rows = self.queries.run(self.reader(), 'spotsearch', (prog, lastseen),
+                                region=region or None,
+                                call=Queries.prefix(call) if call else None,
+                                maxfreq=maxfreq or None)
 
-        if region:
-            q_reg = f"region = '{region}' and"
-        else:
-            q_reg = ""
-
-        if call:
-            q_call = f"callsign like '{call}%' and"
-        else:
-            q_call = ""
-
-        if maxfreq:
-            q_freq = f"freq <= {maxfreq} and"
-        else:
-            q_freq = ""
-
-        q = f"select distinct callsign,ref from mdspots2 where prog = '{prog}' and {q_reg} {q_call} {q_freq} utc > {lastseen}"
-
-        for s in self.cur.execute(q + ' order by utc desc'):
-            (call, ref) = s
-            q = f"select time,callsign,freq,mode,comment from mdspots2 where callsign ='{call}' and ref='{ref}' and utc > {lastseen} order by utc desc"
-            l = self.cur2.execute(q)
-            e = l.fetchone()
-            (tm, call, freq, mode, comment) = e
+        for s in rows:
+            (tm, call, ref, freq, mode, comment) = s
             if (mode == comment):
                 comment = ''
             mesg += f"{tm} {ref} {call} {freq} {mode} {comment}\n"
@@ -432,44 +1560,46 @@ class MDSpotter:
         return (count, mesg)
 
     def stats(self, prog, region, call, mode, now, twindow):
-        if region:
-            q_reg = f"region like '{region}%' and"
-        else:
-            q_reg = ""
+        since = now - twindow
+        hour = since - since % 3600 + (3600 if since % 3600 else 0)
+        filters = {'region': Queries.prefix(region) if region else None,
+                   'call': Queries.prefix(call) if call else None,
+                   'mode': mode or None}
 
+        match = {}
+        if region:
+            match['region'] = SpotArchive.prefix(region)
         if call:
-            q_call = f"callsign like '{call}%' and"
-        else:
-            q_call = ""
-
+            match['callsign'] = SpotArchive.prefix(call)
         if mode:
-            q_mod = f"mode = '{mode}' and"
-        else:
-            q_mod = ""
-
-        reg_q_all = f"select ref,callsign,count(callsign) from mdspots2' \
-            ' where prog = '{prog}' and {q_reg} {q_call} {q_mod} utc > {now - twindow} group by ref, callsign order by utc"
-
-        reg_q_tweet = f"select ref,callsign,count(callsign) from mdspots2' \
-            ' where prog = '{prog}' and {q_reg} {q_call} {q_mod} tweeted = 1 and utc > {now - twindow} group by ref, callsign"
+            match['mode'] = lambda m: m == mode
+
+        rows = []
+        start = hour
+        [(horizon,)] = self.queries.run(self.reader(), 'rollup_horizon', (prog,))
+        if since < (horizon or now):
+            if self.archive:
+                rows = self.archive.counts(prog, since, horizon or now, match)
+        elif since < hour:
+            [(oldest,)] = self.queries.run(self.reader(), 'horizon', (prog,))
+            if since >= (oldest or now):
+                rows = self.queries.run(self.reader(), 'stats', (prog, since, hour), **filters)
+            elif self.archive:
+                rows = self.archive.counts(prog, since, min(oldest or hour, hour), match)
+                rows += self.queries.run(self.reader(), 'stats', (prog, since, hour), **filters)
+            else:
+                start = hour - 3600
+        rows += self.queries.run(self.reader(), 'rollup_stats', (prog, start), **filters)
 
         refmap = {}
 
         (twtall, spotall) = (0, 0)
-        for s in self.cur.execute(reg_q_all):
-            (ref, call, count) = s
+        for s in rows:
+            (ref, call, count, tweeted) = s
             spotall += count
-            if not ref in refmap:
-                refmap[ref] = {call: (0, count)}
-            else:
-                refmap[ref][call] = (0, count)
-
-        for s in self.cur.execute(reg_q_tweet):
-            (ref, call, count) = s
-            twtall += count
-            if ref in refmap and call in refmap[ref]:
-                (_, total) = refmap[ref][call]
-                refmap[ref][call] = (count, total)
+            twtall += tweeted
+            (t, c) = refmap.setdefault(ref, {}).get(call, (0, 0))
+            refmap[ref][call] = (t + tweeted, c + count)
 
         if spotall != 0:
             if mode:
@@ -492,11 +1622,11 @@ class MDSpotter:
         return mesg
 
     def interp(self, cmd):
-        self.now = int(datetime.utcnow().strftime("%s"))
+        now = int(datetime.utcnow().strftime("%s"))
         command = cmd.upper().split()
         prog = self.programs[0]
-        (region, locpfx, call, mode, maxfreq, logmode, statmode, twindow) = (
-            'JA', None, None, None, None, False, False, 3600)
+        (region, locpfx, call, mode, maxfreq, logmode, statmode, twindow, nfer) = (
+            'JA', None, None, None, None, False, False, 3600, None)
 
         for cmd in command:
             if cmd == 'JA':
@@ -516,6 +1646,11 @@ class MDSpotter:
                 mode = cmd
             elif cmd in ['SOTA', 'POTA']:
                 prog = cmd.lower()
+            elif re.fullmatch(r'\d+FER', cmd):
+                nfer = int(cmd[:-3])
+                if not (logmode or statmode):
+                    logmode = True
+                    twindow = 12 * 3600
             elif cmd.isdigit():
                 if logmode or statmode:
                     twindow = int(cmd) * 3600
@@ -528,15 +1663,16 @@ class MDSpotter:
                     region = cmd
 
         if statmode:
-            mesg = self.stats(prog, region, call, mode, self.now, twindow)
+            mesg = self.stats(prog, region, call, mode, now, twindow)
 
         elif logmode:
             (stns, refs, mesg) = self.logsearch(
-                prog, region, locpfx, call, twindow)
+                prog, region, locpfx, call, twindow, now, nfer)
             mesg = self.summary_mesg(call, twindow/3600, stns, refs, mesg)
 
         else:
-            (_, mesg) = self.spotsearch(prog, region, call, maxfreq, twindow)
+            (_, mesg) = self.spotsearch(
+                prog, region, call, maxfreq, twindow, now)
 
         return mesg
 
@@ -572,60 +1708,35 @@ class MDSpotter:
     #                 return
 
     def summary(self, prog):
-        (stns, refs, mesg) = self.logsearch(prog, 'JA',
-                                            'JP', None, self.config[prog]['summary'] * 3600)
+        try:
+            (stns, refs, mesg) = self.logsearch(prog, 'JA',
+                                                'JP', None, self.config[prog]['summary'] * 3600)
+        except sqlite3.Error as e:
+            self.log(f"Warning:{e} summary {prog}")
+            return False
         mesg = self.summary_mesg(
             None, self.config[prog]['summary'], stns, refs, mesg)
-        mesg_md = mesg
 
-        res = None
-        tm = ''
-        if stns > 0:
-            for m in mesg.splitlines():
-                if len(tm + m) > 270:
-                    res = self.tweet_as_reply(prog, res, tm.rstrip())
-                    tm = m + '\n'
-                else:
-                    tm += m + '\n'
-            mesg = tm
-        self.tweet_as_reply(prog, res, mesg.rstrip())
-
-        res = None
-        tm = ''
-        if stns > 0:
-            for m in mesg_md.splitlines():
-                if len(tm + m) > 490:
-                    res = self.toot_as_reply(prog, res, tm.rstrip())
-                    tm = m + '\n'
-                else:
-                    tm += m + '\n'
-            mesg = tm
-        self.toot_as_reply(prog, res, mesg.rstrip())
-
-        res = None
-        tm = ''
-        if stns > 0:
-            for m in mesg_md.splitlines():
-                if len(tm + m) > 2048:
-                    res = self.post_nostr_event(prog, res, tm.rstrip())
-                    tm = m + '\n'
-                else:
-                    tm += m + '\n'
-            mesg = tm
-        self.post_nostr_event(prog, res, tm.rstrip())
+        self.post('tweet', prog, self.chunks(mesg, 270))
+        self.post('toot', prog, self.chunks(mesg, 490))
+        self.post('nostr', prog, self.chunks(mesg, 2048))
+        return True
 
     def is_selfspot(self, spotter, activator):
         sp = re.sub('-\d+|/\d+|/P', '', spotter.upper())
         return sp in activator.upper()
 
-    def alerts(self, prog):
+    def alerts(self, prog, alertdata=None):
         self.now = int(datetime.utcnow().strftime("%s"))
 
         alert_from = self.now - 3600 * 4
         alert_to = self.now + 3600 * 12
 
         try:
-            alertdata = self.getJSON(prog, 'alerts')
+            if alertdata is None:
+                alertdata = self.getJSON(prog, 'alerts')
+            elif isinstance(alertdata, Exception):
+                raise alertdata
         except Exception as e:
             self.log(f"Warning:{e} {self.endpoints[prog]['alerts']}")
             return
@@ -660,31 +1771,56 @@ class MDSpotter:
         res.insert(0, tm)
         return res
 
-    def spots(self, prog):
+    def spots(self, prog, spotdata=None):
         self.now = int(datetime.utcnow().strftime("%s"))
 
         try:
-            spotdata = self.getJSON(prog, 'spots')
+            if spotdata is None:
+                spotdata = self.getJSON(prog, 'spots')
+            elif isinstance(spotdata, Exception):
+                raise spotdata
         except Exception as e:
             self.log(f"Warning:{e} {self.endpoints[prog]['spots']}")
             return
 
+        if isinstance(spotdata, JSONArray) and not spotdata:
+            self.fetcher.accept(spotdata)
+
         if spotdata:
-            tr = self.translates['spots'][prog]
-            spots = [s for s in spotdata[::-1]
-                     if int(s[tr['id']]) > self.lastid[prog]]
+            metrics = self.metrics
+            t = time.perf_counter()
+            (sid_of, ref_of, extract) = self.extractors[prog]
+            lastid = self.lastid[prog]
+            if spotdata is NOT_MODIFIED:
+                spots = []
+            elif isinstance(spotdata, JSONArray):
+                spots = []
+                try:
+                    for s in spotdata:
+                        if int(sid_of(s)) <= lastid:
+                            break
+                        spots.append(s)
+                except (ValueError, IndexError) as e:
+                    self.log(f"Warning:{e} {self.endpoints[prog]['spots']}")
+                    return
+                spots.reverse()
+                self.fetcher.accept(spotdata)
+            else:
+                spots = [s for s in spotdata[::-1] if int(sid_of(s)) > lastid]
+            t = metrics.lap('filter', prog, t)
+            if prog == 'pota':
+                self.prefetch_refnames(ref_of(s) for s in spots)
+                t = metrics.lap('refname', prog, t)
+
+            rows = []
+            infos = []
+            suppress = self.suppress[prog]
+            suppress.prune(self.now)
             for s in spots:
-                sid = s[tr['id']]
-                ref = '/'.join(s[x] for x in tr['ref'])
-                activator = s[tr['act']]
-                freq = s[tr['freq']]
-                mode = s[tr['mode']]
-                name = s[tr['name']]
-                loc = s[tr['loc']]
-                spotter = s[tr['spotter']]
-                comment = s[tr['comments']]
-
-                tstr = re.sub(r'\.\d+', r'', s[tr['time']])
+                (ref, activator, freq, mode, name, loc,
+                 spotter, comment, tstr) = extract(s)
+
+                tstr = re.sub(r'\.\d+', r'', tstr)
                 hhmm = datetime.fromisoformat(tstr).strftime('%H:%M')
 
                 if not spotter:
@@ -717,25 +1853,20 @@ class MDSpotter:
                 except ValueError:
                     rfreq = 0.0
 
+                key = (activator, ref, rfreq, mode)
+                t = time.perf_counter()
                 if not self.is_selfspot(spotter, activator):
-                    q = f"select count(*) from mdspots2 where prog = '{prog}' and " \
-                        f"utc > {self.now - self.config[prog]['suppress_interval']} and " \
-                        f"callsign = '{activator}' and ref = '{ref}' and " \
-                        f"freq = {rfreq} and mode = '{mode}' and tweeted = 1"
-
-                    self.cur.execute(q)
-                    (count,) = self.cur.fetchall()[0]
-                    if count == 0:
-                        skip_this = False
-                    else:
-                        skip_this = True
+                    skip_this = suppress.seen(key, self.now)
                 else:
                     skip_this = False
+                t = metrics.lap('suppress', prog, t)
 
                 if not skip_this:
+                    suppress.add(key, self.now)
 
                     if prog == 'pota':
                         (_, name_k) = self.refNamequery(ref)
+                        t = metrics.lap('refname', prog, t)
                         if name_k:
                             mesg = f'{hhmm} {activator} on {ref}({name_k} {name}, {loc}) {freq} {mode} {comment}[{spotter}]'
                         else:
@@ -749,13 +1880,14 @@ class MDSpotter:
                     m = re.match(self.config[prog]['filter'], ref)
                     if m:
                         if self.config[prog]['enable_tweet']:
-                            self.tweet_as_reply(prog, None, mesg)
+                            self.post('tweet', prog, [mesg])
 
                         if self.config[prog]['enable_toot']:
-                            self.toot_as_reply(prog, None, mesg)
+                            self.post('toot', prog, [mesg])
 
                         if self.config[prog]['enable_nostr']:
-                            self.post_nostr_event(prog, None, mesg)
+                            self.post('nostr', prog, [mesg])
+                    t = metrics.lap('post', prog, t)
 
                     if self.config[prog]['enable_mqtt']:
                         it = iter(self.config[prog]['mqtt_topic'])
@@ -764,18 +1896,36 @@ class MDSpotter:
                             if m:
                                 self.mqtt_publish(topic, mesg)
                                 self.mqtt_publish_client(topic, mesg_json)
+                        metrics.lap('fanout', prog, t)
 
-                q = 'insert into mdspots2(utc, time, prog, callsign, ref, name, freq, rawfreq, mode, loc, region, comment, spotter, tweeted) values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
-                self.cur.execute(q, (self.now, hhmm, prog, activator, ref, name,
-                                     rfreq, freq, mode, loc, region, comment, spotter, 0 if skip_this else 1))
+                self.spotrow += 1
+                rows.append((self.spotrow, self.now, hhmm, prog, activator, ref, name,
+                             rfreq, freq, mode, loc, region, comment, spotter, 0 if skip_this else 1))
 
-                tlwindow = self.now - 3600 * 24 * \
-                    self.config[prog]['storage_period']
-                self.cur.execute(
-                    f'delete from mdspots2 where utc < {tlwindow}')
+                if spotter in activator and comment:
+                    info = self.comments.parse(ref, comment)
+                    if info:
+                        infos.append(self.comments.row(self.spotrow, self.now, prog,
+                                                       activator, ref, info))
+                else:
+                    info = None
+                self.activations.add(self.now, hhmm, prog, activator, ref,
+                                     rfreq, mode, region, info)
+                self.rollups.add(self.now, prog, region, ref, activator, mode,
+                                 0 if skip_this else 1)
+
+            t = time.perf_counter()
+            self.queries.runmany(self.cur, 'insert_spot', rows)
+            self.comments.insert(infos)
+            self.rollups.flush()
+            self.activations.flush()
+            self.activations.prune(self.now)
+            metrics.incr('spots_total', len(rows), prog=prog)
+            metrics.incr('published_total', sum(r[-1] for r in rows), prog=prog)
 
             if spots:
-                self.lastid[prog] = max(int(i[tr['id']]) for i in spots)
+                self.lastid[prog] = max(int(sid_of(i)) for i in spots)
+                self.saveLastId(prog)
                 mesg = f'Latest {prog} spot id{self.lastid[prog]}.'
             else:
                 mesg = f'No {prog} spots since id{self.lastid[prog]}.'
@@ -785,40 +1935,152 @@ class MDSpotter:
                 self.mqtt_publish('debug', mesg)
 
             self.db.commit()
+            metrics.lap('insert', prog, t)
+            return len(spots)
 
         else:
             self.log(f'No {prog} spots.')
+            return 0
 
-        self.saveLastId()
+    def prune(self):
+        now = int(datetime.utcnow().strftime("%s"))
+        batch = self.config.get('prune_batch', 1000)
 
-    def periodical(self):
         for p in self.programs:
-            self.spots(p)
+            tlwindow = now - 3600 * 24 * self.config[p]['storage_period']
+            if self.archive:
+                tlwindow -= tlwindow % 86400
+                try:
+                    n = self.archive.export(self.cur, p, tlwindow)
+                except Exception as e:
+                    self.log(f"Warning:{e} archive {p}")
+                    continue
+                if n:
+                    self.log(f'Archived {n} {p} spots before {tlwindow}.')
+            deleted = 0
+            while True:
+                self.queries.run(self.cur, 'prune', (tlwindow, p, batch))
+                self.db.commit()
+                deleted += self.cur.rowcount
+                if self.cur.rowcount < batch:
+                    break
+            if deleted:
+                self.log(f'Pruned {deleted} {p} spots before {tlwindow}.')
+
+            self.cur.execute(
+                'delete from spotinfo where utc < ? and prog = ?', (tlwindow, p))
+            keep = max(self.config[p].get('rollup_period', 90), self.config[p]['storage_period'])
+            n = self.rollups.prune(p, now - 3600 * 24 * keep)
+            if n:
+                self.log(f'Pruned {n} {p} hourly rollups.')
+            self.cur.execute(
+                'delete from activations where prog = ? and last_utc < ?', (p, tlwindow))
+            self.db.commit()
 
-    def daily_alerts(self):
-        for p in self.programs:
-            rest = None
-            resm = None
-            resn = None
-            for a in self.alerts(p):
-                rest = self.tweet_as_reply(p, rest, a)
-                resm = self.toot_as_reply(p, resm, a)
-                resn = self.post_nostr_event(p, resn, a)
-
-    def daily_summary(self):
-        for p in self.programs:
-            self.summary(p)
+        self.db.execute('pragma optimize')
+
+    def periodical(self, programs=None):
+        programs = programs or self.programs
+        t = time.perf_counter()
+        feeds = self.getJSON_all((p, 'spots') for p in programs)
+        res = {p: self.spots(p, feeds.get((p, 'spots'))) for p in programs}
+        self.metrics.set('cycle_seconds', time.perf_counter() - t)
+        return res
+
+    def publish_metrics(self):
+        if self.mqtt:
+            self.mqtt.publish(self.config.get('metrics_topic', 'metrics'),
+                              json.dumps(self.metrics.snapshot()))
+        if self.config.get('metrics_textfile'):
+            try:
+                self.metrics.textfile(self.config['metrics_textfile'])
+            except Exception as e:
+                self.log(f"Warning:{e} {self.config['metrics_textfile']}")
+
+    def fetch_report(self):
+        for r in self.fetcher.report():
+            self.log(f'Fetch {r}')
+
+    def daily_alerts(self, programs=None):
+        programs = programs or self.programs
+        feeds = self.getJSON_all((p, 'alerts') for p in programs)
+        for p in programs:
+            res = self.alerts(p, feeds.get((p, 'alerts')))
+            if res is None:
+                continue
+            self.setCursor(f'alerts/{p}', int(time.time()))
+            self.post('tweet', p, res)
+            self.post('toot', p, res)
+            self.post('nostr', p, res)
+        self.db.commit()
+
+    def daily_summary(self, programs=None):
+        for p in programs or self.programs:
+            if self.summary(p):
+                self.setCursor(f'summary/{p}', int(time.time()))
+        self.db.commit()
+
+    def missed(self, name, at):
+        (h, m) = map(int, at.split(':'))
+        due = int(datetime.now().replace(hour=h, minute=m, second=0, microsecond=0).timestamp())
+        if time.time() < due:
+            return []
+        return [p for p in self.programs
+                if f'{name}/{p}' in self.cursors and self.cursors[f'{name}/{p}'] < due]
+
+    def serve_queries(self):
+        sockname = self.config.get(
+            'query_socket', self.config['homedir'] + 'mdspots.sock')
+        if os.path.exists(sockname):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                try:
+                    s.connect(sockname)
+                    raise RuntimeError(f'Another server is answering on {sockname}')
+                except ConnectionRefusedError:
+                    os.unlink(sockname)
+
+        server = socketserver.UnixStreamServer(sockname, QueryHandler)
+        server.spotter = self
+        threading.Thread(target=server.serve_forever,
+                         name='query', daemon=True).start()
+        self.log(f"Query service on {sockname}")
 
     def run(self):
+        import schedule
+
         self.log(f"Start MDSpot Server {__file__}")
+        self.serve_queries()
 
-        schedule.every(self.config['interval']).seconds.do(self.periodical)
+        schedule.every(self.config.get('prune_interval', self.config['interval'])).seconds.do(
+            self.prune)
         schedule.every().day.at(self.config['alerts']).do(self.daily_alerts)
         schedule.every().day.at(self.config['summary']).do(self.daily_summary)
-
+        for (name, job) in [('alerts', self.daily_alerts), ('summary', self.daily_summary)]:
+            missed = self.missed(name, self.config[name])
+            if missed:
+                self.log(f"Catching up missed {name} for {', '.join(missed)}.")
+                job(missed)
+        schedule.every(self.config.get('fetch_report_interval', 3600)).seconds.do(
+            self.fetch_report)
+        schedule.every(self.config.get('metrics_interval', 60)).seconds.do(
+            self.publish_metrics)
+
+        polls = PollScheduler(self.programs, self.config, self.endpoints)
         while True:
+            due = polls.due(time.monotonic())
+            if due:
+                res = self.periodical(due)
+                now = time.monotonic()
+                for p in due:
+                    self.metrics.set('interval_seconds',
+                                     polls.update(p, res[p], now), prog=p)
+
             schedule.run_pending()
-            time.sleep(10)
+
+            wait = min(polls.next_due() - time.monotonic(),
+                       schedule.idle_seconds())
+            if wait > 0:
+                time.sleep(wait)
 
 
 if __name__ == "__main__":
@@ -831,18 +2093,21 @@ if __name__ == "__main__":
     translates = {
         'alerts': systemobj['alert_translates'], 'spots': systemobj['spot_translates']}
 
-    spotter = MDSpotter(programs=systemobj['programs'],
-                        endpoints=systemobj['endpoints'],
-                        translates=translates,
+    def spotter(readonly=False):
+        return MDSpotter(programs=systemobj['programs'],
+                         endpoints=systemobj['endpoints'],
+                         translates=translates,
 
-                        accesskeys=configobj['accesskeys'],
-                        config=configobj['config'])
+                         accesskeys=configobj['accesskeys'],
+                         config=configobj['config'],
+                         readonly=readonly)
 
     if len(sys.argv) == 1:
-        spotter.run()
+        spotter().run()
     else:
         command = sys.argv[1]
         if command == 'create_app':
+            from mastodon import Mastodon
             appname = input('Application Name:')
             baseurl = input('Mastodon API Base URL:')
             tofile = input('Client Credential File:')
@@ -852,6 +2117,7 @@ if __name__ == "__main__":
                                 )
 
         elif command == 'create_token':
+            from mastodon import Mastodon
             clientsecret = input('Client Credential File:')
             account = input('Mastodon Account:')
             password = input('Mastodon Password:')
@@ -863,5 +2129,14 @@ if __name__ == "__main__":
                 to_file=tofile
             )
         else:
-            print(spotter.interp(' '.join(sys.argv[1:])))
-            del spotter
+            cmd = ' '.join(sys.argv[1:])
+            config = configobj['config']
+            try:
+                print(query(config.get('query_socket', config['homedir'] + 'mdspots.sock'), cmd))
+            except OSError:
+                try:
+                    s = spotter(readonly=True)
+                except (RuntimeError, sqlite3.Error) as e:
+                    sys.exit(f'Error:{e}')
+                print(s.interp(cmd))
+                del s